@@ -3,8 +3,8 @@
 # gptungif.py - gptungif is a .gptgif file format (a certain type of standard .gif file),
 # decoder tool (reference python implementation).
 #
-# Extracts visual hex values from an animated GIF file and decodes it using
-# the xxd -p -r command, then zips it with gzip -9 before outputting. Meant to be used in
+# Extracts visual hex values from an animated GIF file and decodes them back to
+# bytes (as xxd -p -r would), then zips it with gzip -9 before outputting. Meant to be used in
 # conjunction with an encoder program "gptgif" that generates the GIF file, which contains
 # visual representations of hex values (0-9, a-f) in a specific font.
 #
@@ -14,93 +14,269 @@
 import sys
 import os
 import io
+import re
+import gzip
 import numpy as np
-from PIL import Image, ImageSequence
-import subprocess
-import tempfile
-from sklearn.cluster import KMeans
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 
 GLYPH_WIDTH = 8
 GLYPH_HEIGHT = 8
 
-def extract_hex_from_gif(gif_bytes, cluster_map, calibrate=False):
-    gif_image = Image.open(io.BytesIO(gif_bytes))
-    glyph_tiles = []
-    extraction_halted = False
-
-    for frame in ImageSequence.Iterator(gif_image):
-        if extraction_halted:
-            break
-        grayscale = frame.convert("L")
-        binary = (np.array(grayscale) > 128).astype(np.uint8)
-        height, width = binary.shape
-        rows = height // GLYPH_HEIGHT
-        cols = width // GLYPH_WIDTH
-
-        for row in range(rows):
-            if extraction_halted:
-                break
-            for col in range(cols):
-                y0 = row * GLYPH_HEIGHT
-                x0 = col * GLYPH_WIDTH
-                glyph = binary[y0:y0+GLYPH_HEIGHT, x0:x0+GLYPH_WIDTH]
-                if np.sum(glyph) < 5:
-                    extraction_halted = True
-                    break
-                glyph_tiles.append(glyph)
+# Same DOS-style hex font as gptgif.c, one byte per glyph row (MSB = leftmost pixel).
+# A binarized 8x8 glyph packed row-by-row into a big-endian uint64 gives the same
+# bit pattern, so these double as the default lookup keys.
+FONT = [
+    [0x00,0x3C,0x66,0x6E,0x76,0x66,0x3C,0x00], # 0
+    [0x00,0x18,0x38,0x18,0x18,0x18,0x3C,0x00], # 1
+    [0x00,0x3C,0x66,0x0C,0x18,0x30,0x7E,0x00], # 2
+    [0x00,0x3C,0x66,0x1C,0x06,0x66,0x3C,0x00], # 3
+    [0x00,0x0C,0x1C,0x2C,0x4C,0x7E,0x0C,0x00], # 4
+    [0x00,0x7E,0x60,0x7C,0x06,0x66,0x3C,0x00], # 5
+    [0x00,0x3C,0x60,0x7C,0x66,0x66,0x3C,0x00], # 6
+    [0x00,0x7E,0x06,0x0C,0x18,0x30,0x30,0x00], # 7
+    [0x00,0x3C,0x66,0x3C,0x66,0x66,0x3C,0x00], # 8
+    [0x00,0x3C,0x66,0x66,0x3E,0x06,0x3C,0x00], # 9
+    [0x00,0x3C,0x06,0x3E,0x66,0x66,0x3E,0x00], # a
+    [0x00,0x60,0x60,0x7C,0x66,0x66,0x7C,0x00], # b
+    [0x00,0x3C,0x60,0x60,0x60,0x60,0x3C,0x00], # c
+    [0x00,0x06,0x06,0x3E,0x66,0x66,0x3E,0x00], # d
+    [0x00,0x3C,0x66,0x7E,0x60,0x60,0x3C,0x00], # e
+    [0x00,0x1C,0x30,0x30,0x7C,0x30,0x30,0x00], # f
+]
 
-    flat_tiles = [np.ravel(np.ascontiguousarray(tile)) for tile in glyph_tiles]
-    X = np.stack(flat_tiles)
-    kmeans = KMeans(n_clusters=len(cluster_map), random_state=0, n_init=10)
-    labels = kmeans.fit_predict(X)
+# Grayscale -> 1-bit threshold table, built once instead of per frame by Image.point().
+THRESHOLD = [255 if p > 128 else 0 for p in range(256)]
 
-    if calibrate:
-        print("K-Means Cluster Centroids (visualized as 8x8 glyphs):", file=sys.stderr)
-        for i, center_vector in enumerate(kmeans.cluster_centers_):
-            print(f"\nCluster Label: {i}", file=sys.stderr)
-            glyph_center = center_vector.reshape(GLYPH_HEIGHT, GLYPH_WIDTH)
-            for row_pixels in glyph_center:
-                print("".join(['#' if p > 0.5 else '.' for p in row_pixels]), file=sys.stderr)
-            print("-" * 20, file=sys.stderr)
-        print("\nNow associate each index with the correct character from the cluster map.", file=sys.stderr)
+HEX_CHARS = "0123456789abcdefABCDEF"
+HEX_DIGITS = re.compile(r"[0-9a-fA-F]*")
 
-    hex_string = ''.join(cluster_map[label] for label in labels)
-    return hex_string
+# Set bits per byte, for popcounts over packed glyph rows.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount64(keys):
+    # np.bitwise_count (NumPy >= 2.0) maps to the CPU popcount instruction;
+    # older NumPy falls back to the byte table.
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(keys)
+    return POPCOUNT[keys.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+def default_glyph_map(cluster_map):
+    return {int.from_bytes(bytes(rows), "big"): char for rows, char in zip(FONT, cluster_map)}
 
-def decode_with_bash_pipeline(hex_string):
-    with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".hex") as hex_string_file:
-        hex_string_file.write(hex_string)
-        hex_string_file_path = hex_string_file.name
+def load_glyph_map(path):
+    # One "<16 hex digit key> <char>" pair per line, as printed by --calibrate.
+    # Lines starting with '#' are comments, so '#' itself can still be a label.
+    glyph_map = {}
+    with open(path, "r") as glyph_map_file:
+        for line_number, line in enumerate(glyph_map_file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError(f"{path}:{line_number}: expected '<glyph key> <char>', got {line!r}")
+            key, char = fields
+            try:
+                key = int(key, 16)
+            except ValueError:
+                key = -1
+            if not 0 <= key < 1 << 64:
+                raise ValueError(f"{path}:{line_number}: glyph key must be a hex number of at most 16 digits, got {fields[0]!r}")
+            if len(char) != 1 or not char.isascii():
+                raise ValueError(f"{path}:{line_number}: glyph character must be a single ASCII character, got {char!r}")
+            glyph_map[key] = char
+    return glyph_map
 
-    bash_script = f"xxd -p -r < {hex_string_file_path} | gzip -9"
-    with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".sh") as script_file:
-        script_file.write(bash_script)
-        script_path = script_file.name
+def resolve_glyphs(keys, glyph_map):
+    # Keys that are not an exact match (e.g. a few pixels lost to thresholding)
+    # are matched to the closest glyph_map key by Hamming distance; returns
+    # them as key -> matched key. All misses are matched against glyph_map in
+    # one batch, never against each other.
+    missing = [key for key in set(keys) if key not in glyph_map]
+    if not missing:
+        return {}
+    known = np.array(list(glyph_map), dtype=np.uint64)
+    misses = np.array(missing, dtype=np.uint64)
+    distances = popcount64(np.bitwise_xor(misses[:, None], known[None, :]).ravel()).reshape(len(misses), len(known))
+    return dict(zip(missing, known[np.argmin(distances, axis=1)].tolist()))
 
-    result = subprocess.run(
-        ["bash", "-i", "-l", script_path],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+def print_glyph_key(key):
+    for row_byte in key.to_bytes(8, "big"):
+        print("".join('#' if row_byte & (0x80 >> bit) else '.' for bit in range(8)), file=sys.stderr)
 
-    os.unlink(script_path)
-    os.unlink(hex_string_file_path)
+def frame_bits(frame):
+    # Threshold straight into a 1 bit/pixel image. Each packed row byte
+    # then covers exactly one glyph column, since glyphs are 8 pixels wide.
+    bw = frame.convert("L").point(THRESHOLD, mode="1")
+    # tobytes() on a mode '1' image runs Pillow's bit-packing encoder and is
+    # much slower than reading the pixels through the array interface and
+    # packing them with NumPy, which gives the same bytes.
+    return np.packbits(np.asarray(bw), axis=1)
+
+def glyph_keys_of(packed, width):
+    # (..., height, row bytes) packed frames -> one uint64 key per glyph cell,
+    # frame by frame, row by row. Each key is a glyph's 8 row bytes.
+    rows = packed.shape[-2] // GLYPH_HEIGHT
+    cols = width // GLYPH_WIDTH
+    glyph_rows = (packed[..., :rows*GLYPH_HEIGHT, :cols]
+                  .reshape(-1, rows, GLYPH_HEIGHT, cols)
+                  .swapaxes(2, 3)
+                  .reshape(-1, GLYPH_HEIGHT))
+    return glyph_rows.view(">u8").ravel()
+
+def glyphs_before_terminator(keys):
+    # Keys of the glyphs before the first blank cell, found in one pass over every frame's keys.
+    blank = popcount64(keys) < 5
+    return keys[:int(np.argmax(blank))] if blank.any() else keys
+
+def split_gif_frames(gif_bytes):
+    # Cut the GIF into standalone single-frame GIFs: header, screen descriptor and
+    # global palette, followed by one frame's extension and image blocks. That is
+    # only the same picture when each frame is full-screen and opaque, as gptgif
+    # writes them, so return None for anything else (or a truncated file) and
+    # let the caller decode frames in sequence instead.
+    def skip_sub_blocks(pos):
+        while gif_bytes[pos]:
+            pos += gif_bytes[pos] + 1
+        return pos + 1
 
     try:
-        sys.stdout.buffer.write(result.stdout)
-        sys.stderr.write(result.stderr.decode(errors="replace"))
-    except Exception as err:
-        print(f"Exception during output: {err}", file=sys.stderr)
-        print(result.stdout)
-        print(result.stderr.decode(errors="replace"), file=sys.stderr)
+        screen_width = int.from_bytes(gif_bytes[6:8], "little")
+        screen_height = int.from_bytes(gif_bytes[8:10], "little")
+        flags = gif_bytes[10]
+        pos = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+        header = gif_bytes[:pos]
+        frames = []
+        start = pos
+        transparent = False
+        while gif_bytes[pos] != 0x3B:
+            if gif_bytes[pos] == 0x21:
+                if gif_bytes[pos + 1] == 0xF9:
+                    # Graphic control extension: bit 0 of its packed byte is the transparency flag.
+                    transparent = bool(gif_bytes[pos + 3] & 1)
+                pos = skip_sub_blocks(pos + 2)
+            elif gif_bytes[pos] == 0x2C:
+                left, top, frame_width, frame_height = (
+                    int.from_bytes(gif_bytes[pos + offset:pos + offset + 2], "little") for offset in (1, 3, 5, 7))
+                if transparent or (left, top, frame_width, frame_height) != (0, 0, screen_width, screen_height):
+                    return None
+                flags = gif_bytes[pos + 9]
+                pos += 10 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+                pos = skip_sub_blocks(pos + 1)
+                frames.append(header + gif_bytes[start:pos] + b";")
+                start = pos
+                transparent = False
+            else:
+                return None
+    except IndexError:
+        return None
+    return frames or None
+
+def decode_frame_keys(frame_gif):
+    frame = Image.open(io.BytesIO(frame_gif))
+    return glyph_keys_of(frame_bits(frame), frame.width)
+
+def extract_hex_from_gif(gif_bytes, glyph_map, calibrate=False, jobs=1):
+    # Opened up front on both paths so that unreadable input fails the same way.
+    gif_image = Image.open(io.BytesIO(gif_bytes))
+    frame_gifs = split_gif_frames(gif_bytes) if jobs > 1 else None
 
-    sys.exit(result.returncode)
+    if frame_gifs:
+        # Frames are independent, so decode them in parallel and join the
+        # results in frame order before looking for the terminator.
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            frame_keys = list(executor.map(decode_frame_keys, frame_gifs, chunksize=4))
+        glyph_keys = glyphs_before_terminator(np.concatenate(frame_keys))
+    else:
+        width, height = gif_image.size
+        n_frames = getattr(gif_image, "n_frames", 1)
+
+        # Frames all share the screen size, so decode them into one
+        # (n_frames, height, row bytes) stack and key every glyph of every
+        # frame in a single vectorized pass.
+        packed = np.empty((n_frames, height, (width + 7) // 8), dtype=np.uint8)
+        for index in range(n_frames):
+            gif_image.seek(index)
+            packed[index] = frame_bits(gif_image)
+
+        glyph_keys = glyphs_before_terminator(glyph_keys_of(packed, width))
+
+    # Only the distinct keys go through the glyph map; every glyph's character
+    # is then gathered from a per-key byte table through the inverse index.
+    unique_keys, inverse, counts = np.unique(glyph_keys, return_inverse=True, return_counts=True)
+    unique_keys = unique_keys.tolist()
+    matches = resolve_glyphs(unique_keys, glyph_map)
+    chars = [glyph_map[matches.get(key, key)] for key in unique_keys]
+
+    fuzzy = [index for index, key in enumerate(unique_keys) if key in matches]
+    if fuzzy:
+        fuzzy_keys = np.array([unique_keys[index] for index in fuzzy], dtype=np.uint64)
+        nearest_keys = np.array([matches[unique_keys[index]] for index in fuzzy], dtype=np.uint64)
+        worst = int(popcount64(np.bitwise_xor(fuzzy_keys, nearest_keys)).max())
+        print(f"Warning: {len(fuzzy)} glyph pattern(s) ({int(counts[fuzzy].sum())} cells) matched no known glyph exactly "
+              f"and were decoded as the nearest one (worst Hamming distance {worst}). "
+              f"The output may be corrupt; run --calibrate to check.", file=sys.stderr)
+
+    if calibrate:
+        # Font glyphs dominate the counts, so the real patterns come first and
+        # one-off noise patterns sink to the bottom.
+        order = np.argsort(counts, kind="stable")[::-1]
+        print("Distinct glyph bit patterns, most frequent first (key, count, current character, 8x8 bitmap):", file=sys.stderr)
+        for index, count in zip(order.tolist(), counts[order].tolist()):
+            key = unique_keys[index]
+            print(f"\nGlyph Key: {key:016x}  seen {count}x  (currently '{chars[index]}')", file=sys.stderr)
+            print_glyph_key(key)
+            print("-" * 20, file=sys.stderr)
+        print("\nNow label each key with its character in a --glyph-map file, one '<key> <char>' per line.", file=sys.stderr)
+
+    table = np.frombuffer(''.join(chars).encode("ascii"), dtype=np.uint8)
+    hex_string = table[inverse].tobytes().decode("ascii")
+    return hex_string
+
+def hex_to_bytes(hex_string):
+    if HEX_DIGITS.fullmatch(hex_string):
+        return bytes.fromhex(hex_string[:len(hex_string) - len(hex_string) % 2])
+    # Labels outside 0-9a-f: replay the `xxd -p -r` parser so the bytes match
+    # what the shell pipeline produced. Spaces, tabs and line breaks are skipped,
+    # any other character drops a pending half byte, three non-hex characters
+    # in a row discard the rest of the line, and leading junk is ignored.
+    out = bytearray()
+    n1 = n2 = -1
+    ignore = True
+    chars = iter(hex_string)
+    for c in chars:
+        if c in " \t\r\n":
+            continue
+        n3, n2 = n2, n1
+        n1 = int(c, 16) if c in HEX_CHARS else -1
+        if n1 < 0 and ignore:
+            continue
+        ignore = False
+        if n1 < 0 and n2 < 0 and n3 < 0:
+            for c in chars:
+                if c == "\n":
+                    ignore = True
+                    break
+            continue
+        if n1 >= 0 and n2 >= 0:
+            out.append(n2 << 4 | n1)
+            n1 = -1
+    return bytes(out)
+
+def decode_hex_to_gzip(hex_string):
+    # In-process equivalent of `xxd -p -r | gzip -9`.
+    raw = hex_to_bytes(hex_string)
+    sys.stdout.buffer.write(gzip.compress(raw, compresslevel=9, mtime=0))
+    sys.stdout.buffer.flush()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Decode a .gptgif with optional cluster-map override.")
     parser.add_argument("--calibrate", action="store_true", help="Run in calibration mode.")
-    parser.add_argument("--cluster-map", type=str, help="ASCII characters ordered by cluster index (use 0x... for hex)")
+    parser.add_argument("--cluster-map", type=str, help="ASCII characters ordered by font glyph index (use 0x... for hex)")
+    parser.add_argument("--glyph-map", type=str, help="Calibration file of '<glyph key> <char>' lines, applied over the built-in font")
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes for frame decoding (0 = one per CPU core)")
     args = parser.parse_args()
 
     if args.cluster_map:
@@ -109,18 +285,24 @@ if __name__ == "__main__":
             cluster_map = raw[2:]
         else:
             cluster_map = raw
+        if not cluster_map.isascii():
+            parser.error(f"--cluster-map must contain only ASCII characters, got {cluster_map!r}")
     else:
         cluster_map = "0123456789abcdef"
         print("Warning: --cluster-map not specified. Defaulting to '0123456789abcdef'", file=sys.stderr)
 
+    glyph_map = default_glyph_map(cluster_map)
+    if args.glyph_map:
+        glyph_map.update(load_glyph_map(args.glyph_map))
+
     try:
         gif_data = sys.stdin.buffer.read()
-        hex_output = extract_hex_from_gif(gif_data, cluster_map, args.calibrate)
+        hex_output = extract_hex_from_gif(gif_data, glyph_map, args.calibrate, args.jobs or os.cpu_count())
         if args.calibrate:
             print("Calibration complete.", file=sys.stderr)
             sys.exit(0)
         else:
-            decode_with_bash_pipeline(hex_output)
+            decode_hex_to_gzip(hex_output)
     except Exception as err:
         print(f"Exception during processing: {err}", file=sys.stderr)
         raise